@@ -0,0 +1,16 @@
+# Byte units and their divisors, in steps of 1000
+BYTE_UNITS = ('B', 'KB', 'MB', 'GB', 'TB', 'PB', 'EB', 'ZB', 'YB')
+BYTE_DIVISORS = tuple(1000**i for i in range(len(BYTE_UNITS)))
+
+
+def format_bytes(bytes_num):
+    # Estimate the unit from the bit length. Since 1024**i >= 1000**i, the
+    # estimate is never too large and at most one unit too small. Correct it
+    # with the float quotient, which rounds up at unit boundaries the same way
+    # repeated division by 1000.0 does.
+    unit_index = min((max(int(bytes_num), 1).bit_length() - 1) // 10,
+                     len(BYTE_UNITS) - 1)
+    if unit_index < len(BYTE_UNITS) - 1 and bytes_num / BYTE_DIVISORS[unit_index] >= 1000:
+        unit_index += 1
+
+    return f"{bytes_num / BYTE_DIVISORS[unit_index]:.2f} {BYTE_UNITS[unit_index]}"
@@ -1,18 +1,54 @@
 #!/bin/python3
 
 import os
+import heapq
+import json
+import sys
 import psutil
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
 import argparse
-import multiprocessing
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+from bytes_format import format_bytes
 
 DEFAULT_EWMA_ALPHA = 0.1        # Default alpha value for EWMA filter
 # Time interval in seconds between each RAM usage check
 DEFAULT_INTERVAL_SEC = 1
 # Relative increase in RAM usage to trigger a pprof capture (in megabytes)
 DEFAULT_TRIGGER_LEVEL_MB = 1024
+# Number of processes (largest RSS first) written to each capture
+TOP_PROCESS_COUNT = 100
+# (connect, read) timeouts in seconds for pprof requests
+PPROF_TIMEOUT_SEC = (3, 60)
+
+# pprof endpoints fetched on each capture
+PPROF_REQUESTS = (
+    '/debug/pprof/heap',
+    '/debug/pprof/goroutine',
+    '/debug/pprof/threadcreate',
+    '/debug/pprof/block',
+    '/debug/pprof/mutex',
+    '/debug/pprof/profile?seconds=5',
+    '/debug/pprof/trace?seconds=5',
+)
+
+# Long-lived pool for fetching pprof endpoints concurrently. Its threads are
+# started on first use and reused across captures.
+PPROF_EXECUTOR = ThreadPoolExecutor(
+    max_workers=len(PPROF_REQUESTS), thread_name_prefix='pprof')
+
+# Shared HTTP session, so the connection to the pprof host is kept alive and
+# reused across endpoints and across captures
+SESSION = requests.Session()
+SESSION.mount('http://', HTTPAdapter(
+    pool_connections=2,
+    pool_maxsize=8,
+    max_retries=Retry(total=3, backoff_factor=0.2)))
 
 
 def get_cli_args():
@@ -29,68 +65,164 @@ def get_cli_args():
     return parser.parse_args()
 
 
+# Cached (second, formatted time) pair for log_timestamp()
+_log_timestamp_cache = (None, "")
+
+
+# Return the current time formatted for log lines. Formatting is memoized per
+# wall-clock second, since many lines are logged within the same second.
+def log_timestamp():
+    global _log_timestamp_cache
+    now = int(time.time())
+    cached_sec, cached_str = _log_timestamp_cache
+    if now != cached_sec:
+        cached_str = time.strftime("%H:%M:%S", time.localtime(now))
+        _log_timestamp_cache = (now, cached_str)
+    return cached_str
+
+
+# /proc/meminfo fields needed to compute used RAM
+MEMINFO_FIELDS = (b'\nMemTotal:', b'\nMemFree:', b'\nBuffers:', b'\nCached:',
+                  b'\nSReclaimable:')
+# File descriptor for /proc/meminfo, kept open between samples
+_meminfo_fd = None
+
+
+# Return the used RAM in bytes, computed the same way as psutil's
+# virtual_memory().used, by reading /proc/meminfo directly
+def mem_used():
+    global _meminfo_fd
+    try:
+        if _meminfo_fd is None:
+            _meminfo_fd = os.open('/proc/meminfo', os.O_RDONLY)
+        data = b'\n' + os.pread(_meminfo_fd, 4096, 0)
+    except (OSError, AttributeError):
+        # Not on Linux (or os.pread is unavailable)
+        return psutil.virtual_memory().used
+
+    values = []
+    for field in MEMINFO_FIELDS:
+        start = data.find(field)
+        if start < 0:
+            return psutil.virtual_memory().used
+        start += len(field)
+        values.append(int(data[start:data.find(b'kB', start)]) * 1024)
+    total, free, buffers, cached, sreclaimable = values
+    used = total - free - buffers - cached - sreclaimable
+    if used < 0:
+        used = total - free
+    return used
+
+
+# Fetch a single pprof endpoint and stream the response to the given file
+def fetch_pprof(session, endpoint, outfile):
+    with session.get(endpoint, stream=True, timeout=PPROF_TIMEOUT_SEC) as response:
+        # Only create the file once we know the server returned a profile
+        response.raise_for_status()
+        try:
+            with open(outfile, "wb") as file:
+                # Copy in fixed-size chunks rather than buffering the whole
+                # profile in memory. iter_content decodes any transfer encoding
+                # and raises requests exceptions if the body is cut short.
+                for chunk in response.iter_content(1 << 16):
+                    file.write(chunk)
+        except BaseException:
+            # Don't leave a truncated profile behind
+            if os.path.exists(outfile):
+                os.remove(outfile)
+            raise
+
+
 # Capture pprof profiles from the given server
-def capture_pprof(url, outdir):
-    pprof_requests = [
-        '/debug/pprof/heap',
-        '/debug/pprof/goroutine',
-        '/debug/pprof/threadcreate',
-        '/debug/pprof/block',
-        '/debug/pprof/mutex',
-        '/debug/pprof/profile?seconds=5',
-        '/debug/pprof/trace?seconds=5',
-    ]
-    for request in pprof_requests:
-        # Query the server for pprof data
+def capture_pprof(url, outdir, session=SESSION):
+    os.makedirs(outdir, exist_ok=True)
+
+    # Query the server for all pprof data concurrently, since the profile and
+    # trace endpoints each block for several seconds on the server side
+    logtime = log_timestamp()
+    log_lines = []
+    futures = {}
+    for request in PPROF_REQUESTS:
         trace_name = os.path.basename(request)
         outfile = os.path.join(outdir, f"{trace_name}.pb.gz")
-        os.makedirs(outdir, exist_ok=True)
         endpoint = url+request
-        logtime = datetime.now().strftime("%H:%M:%S")
-        print(f"({logtime}) Capturing {request}...")
-        try:
-            response = requests.get(endpoint)
-        except requests.exceptions.RequestException as e:
-            logtime = datetime.now().strftime("%H:%M:%S")
-            print(f"({logtime}) Error sending curl request: {e}")
-
-        # Write to file
-        with open(outfile, "wb") as file:
-            file.write(response.content)
+        log_lines.append(f"({logtime}) Capturing {request}...")
+        futures[PPROF_EXECUTOR.submit(
+            fetch_pprof, session, endpoint, outfile)] = request
+    sys.stdout.write("\n".join(log_lines) + "\n")
+    sys.stdout.flush()
+
+    # Collect errors and write them out together once the capture ends
+    error_lines = []
+    try:
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                # Log and move on, so one failed endpoint doesn't stop the
+                # others from being checked
+                error_lines.append(
+                    f"({log_timestamp()}) Error sending curl request for {futures[future]}: {e}")
+    finally:
+        if error_lines:
+            sys.stdout.write("\n".join(error_lines) + "\n")
+            sys.stdout.flush()
 
 
 # Capture the list of running processes
 def capture_processes(outdir):
     os.makedirs(outdir, exist_ok=True)
-    processes = []
-    for proc in psutil.process_iter(['pid', 'name', 'username']):
-        processes.append({
-            'name': proc.name(),
-            'rss': proc.memory_info().rss,
-            'vms': proc.memory_info().vms,
-            'shared': proc.memory_info().shared,
-            'text': proc.memory_info().text,
-            'lib': proc.memory_info().lib,
-            'data': proc.memory_info().data,
-            'dirty': proc.memory_info().dirty,
+    # Keep only the largest processes in a bounded min-heap while iterating,
+    # rather than building the full process list and selecting from it.
+    # Entries are (rss, pid, row); the pid breaks ties so rows never compare.
+    heap = []
+    # Read each process' name and memory info in a single pass, rather than
+    # re-reading /proc/<pid>/statm for every field
+    for proc in psutil.process_iter(['name', 'memory_info']):
+        info = proc.info
+        mi = info['memory_info']
+        if mi is None:
+            continue
+        rss = mi.rss
+        if len(heap) >= TOP_PROCESS_COUNT and rss <= heap[0][0]:
+            continue
+        entry = (rss, proc.pid, {
+            'pid': proc.pid,
+            'name': info['name'],
+            'rss': rss,
+            'vms': mi.vms,
+            'shared': mi.shared,
+            'text': mi.text,
+            'lib': mi.lib,
+            'data': mi.data,
+            'dirty': mi.dirty,
         })
-    sorted_processes = sorted(
-        processes, key=lambda x: x['rss'], reverse=True)
-    outfile = os.path.join(outdir, "processes_top100.txt")
-    with open(outfile, "wb") as file:
-        for proc in sorted_processes[:100]:
-            file.write(
-                "rss= {: >10},\tvms= {: >10},\tshared= {: >10},\ttext= {: >10},\tlib= {: >10},\tdata= {: >10},\tdirty= {: >10},\tname= {: >10}\n"
-                .format(
-                    format_bytes(proc['rss']),
-                    format_bytes(proc['vms']),
-                    format_bytes(proc['shared']),
-                    format_bytes(proc['text']),
-                    format_bytes(proc['lib']),
-                    format_bytes(proc['data']),
-                    format_bytes(proc['dirty']),
-                    proc['name'],)
-                .encode('utf-8'))
+        if len(heap) < TOP_PROCESS_COUNT:
+            heapq.heappush(heap, entry)
+        else:
+            heapq.heapreplace(heap, entry)
+    top_processes = [row for _, _, row in sorted(heap, reverse=True)]
+    # Write raw byte counts as JSON lines, largest first. Formatting is left to
+    # render_processes.py, keeping it off the capture path.
+    outfile = os.path.join(outdir, "processes_top100.jsonl")
+    with open(outfile, "w", encoding="utf-8", buffering=1 << 16) as file:
+        file.write("".join(
+            json.dumps(proc, separators=(',', ':')) + "\n"
+            for proc in top_processes))
+
+
+# Drain the capture queue, so slow captures don't stall the monitor loop
+def capture_worker(jobs):
+    while True:
+        url, outdir = jobs.get()
+        try:
+            # capture_pprof(url, outdir)
+            capture_processes(outdir)
+        except Exception as e:
+            print(f"({log_timestamp()}) Error capturing {outdir}: {e}")
+            sys.stdout.flush()
+        finally:
+            jobs.task_done()
 
 
 # Log the text and optionally print to console
@@ -104,60 +236,93 @@ def process():
     args = get_cli_args()
 
     # Capture baseline pprof
-    curr = psutil.virtual_memory().used
+    curr = mem_used()
     starttime = datetime.now().strftime("%Y%m%d_%H%M%S")
+    capture_basedir = os.path.join("pprof_traces", starttime)
     # capture_pprof(args.pprof_host,
-    #              f"pprof_traces/{starttime}/initial_{int(curr/1024/1024)}MB")
+    #              os.path.join(capture_basedir, f"initial_{curr >> 20}MB"))
     capture_processes(
-        f"pprof_traces/{starttime}/initial_{int(curr/1024/1024)}MB")
+        os.path.join(capture_basedir, f"initial_{curr >> 20}MB"))
+
+    # Start the background capture worker. The queue holds at most one pending
+    # capture; further triggers are dropped while one is already waiting.
+    capture_jobs = queue.Queue(maxsize=1)
+    threading.Thread(target=capture_worker, args=(capture_jobs,),
+                     daemon=True).start()
 
     # Initialize EWMA filter for ram usage
-    avg_ram_usage = Ewma(args.ewma_alpha, psutil.virtual_memory().used)
+    avg_ram_usage = Ewma(args.ewma_alpha, mem_used())
+
+    # Constant loop parameters
+    trigger_bytes = args.trigger << 20
+    interval = args.interval
+    pprof_host = args.pprof_host
 
     # Periodically monitor the RAM and capture pprof data as needed
+    prev_curr = None
+    prev_avg = None
+    next_tick = time.monotonic()
     while True:
+        # Sleep until the next sampling deadline. Deadlines are absolute on the
+        # monotonic clock, so time spent capturing doesn't stretch the interval.
+        delay = next_tick - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+        # Advance to the next deadline in the future. After an overrun, skip
+        # the missed deadlines rather than sampling again straight away, and
+        # stay on the original phase.
+        now = time.monotonic()
+        if interval > 0:
+            missed = max(0, (now - next_tick) // interval)
+            next_tick += (missed + 1) * interval
+        else:
+            next_tick = now
+
+        logtime = log_timestamp()
+
         # Get current RAM usage
-        curr = psutil.virtual_memory().used
+        curr = mem_used()
+
+        # Skip the tick when it can't change anything: the reading matches the
+        # last one and the EWMA update with it was already a no-op
+        if curr == prev_curr and avg_ram_usage.val == prev_avg:
+            continue
+        prev_curr = curr
+        prev_avg = avg_ram_usage.val
 
         # Update the EWMA
         avg_ram_usage.update(curr)
 
         # Print current RAM stats
-        logtime = datetime.now().strftime("%H:%M:%S")
         print(
             f"({logtime}) RAM usage: current={format_bytes(curr)}, avg={format_bytes(avg_ram_usage.val)}")
 
         # Check for sudden spike in RAM usage
-        trigger = 1024*1024*args.trigger
         delta = curr-avg_ram_usage.val
-        if abs(delta) > trigger:
+        if abs(delta) > trigger_bytes:
             avg_ram_usage.reset(curr)
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            # capture_pprof(args.pprof_host,
-            #              f"pprof_traces/{starttime}/{timestamp}_{int(curr/1024/1024)}MB")
-            capture_processes(
-                f"pprof_traces/{starttime}/{timestamp}_{int(curr/1024/1024)}MB")
+            try:
+                capture_jobs.put_nowait((
+                    pprof_host,
+                    os.path.join(capture_basedir, f"{timestamp}_{curr >> 20}MB")))
+            except queue.Full:
+                print(f"({logtime}) Capture already pending, skipping")
 
-        # Sleep
-        time.sleep(args.interval)
+        # Output is block buffered, so write out this tick's log lines at once
+        sys.stdout.flush()
 
 
-# Main function just kicks off the background process
+# Main function runs the monitor in this process, so the monitor's own memory
+# isn't doubled by a child process. Ctrl-C stops it without a traceback.
 def main():
-    background_process = multiprocessing.Process(target=process)
-    background_process.start()
-    background_process.join()
-
-
-def format_bytes(bytes_num):
-    units = ['B', 'KB', 'MB', 'GB', 'TB', 'PB', 'EB', 'ZB', 'YB']
-    unit_index = 0
-
-    while bytes_num >= 1000 and unit_index < len(units) - 1:
-        bytes_num /= 1000.0
-        unit_index += 1
-
-    return f"{bytes_num:.2f} {units[unit_index]}"
+    # Block buffer stdout, the monitor loop flushes once per tick
+    sys.stdout.reconfigure(line_buffering=False, write_through=False)
+    try:
+        process()
+    except KeyboardInterrupt:
+        pass
 
 
 class Ewma:
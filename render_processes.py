@@ -0,0 +1,42 @@
+#!/bin/python3
+
+import argparse
+import json
+import os
+from bytes_format import format_bytes
+
+# Line format for each process in the rendered table
+PROCESS_LINE_FORMAT = "rss= {: >10},\tvms= {: >10},\tshared= {: >10},\ttext= {: >10},\tlib= {: >10},\tdata= {: >10},\tdirty= {: >10},\tname= {: >10}"
+
+
+def get_cli_args():
+    parser = argparse.ArgumentParser(
+        description='Render a process capture as a human readable table')
+    parser.add_argument('capture', type=str,
+                        help='Capture directory or processes_top100.jsonl file')
+    return parser.parse_args()
+
+
+def main():
+    args = get_cli_args()
+
+    infile = args.capture
+    if os.path.isdir(infile):
+        infile = os.path.join(infile, "processes_top100.jsonl")
+
+    with open(infile, encoding="utf-8") as file:
+        for line in file:
+            proc = json.loads(line)
+            print(PROCESS_LINE_FORMAT.format(
+                format_bytes(proc['rss']),
+                format_bytes(proc['vms']),
+                format_bytes(proc['shared']),
+                format_bytes(proc['text']),
+                format_bytes(proc['lib']),
+                format_bytes(proc['data']),
+                format_bytes(proc['dirty']),
+                proc['name'],))
+
+
+if __name__ == '__main__':
+    main()